@@ -1,12 +1,11 @@
 import asyncio
 import os
 import re
+import tempfile
 import time
-from typing import cast, List, Union, Iterable
-from urllib.parse import urlparse, parse_qs
+from functools import partial
+from typing import cast, List, Optional, Tuple, Union, Iterable
 
-import aiofiles
-import httpx
 from bilibili_api import video, Credential, live, article
 from bilibili_api.favorite_list import get_video_favorite_list_content
 from bilibili_api.opus import Opus
@@ -19,10 +18,13 @@ from nonebot.plugin import PluginMetadata, get_plugin_config
 
 from .bilibili_analysis import (
     download_b_file,
+    download_file,
     merge_file_to_mp4,
     extra_bili_info,
+    fetch_images,
     get_danmaku_and_comments_async,
     generate_wordcloud_from_list,
+    get_client,
 )
 from .ai_summary import get_ai_summary, generate_ai_analysis
 from .config import Config
@@ -47,51 +49,76 @@ GLOBAL_NICKNAME: str = str(plugin_config.r_global_nickname or "Bot")
 BILI_SESSDATA: str = str(plugin_config.bili_sessdata or "")
 VIDEO_DURATION_MAXIMUM: int = int(plugin_config.video_duration_maximum or 480)
 VIDEO_MAX_MB: int = 100  # 假设一个默认值
+AI_ENABLED: bool = bool(plugin_config.gemini_key or (plugin_config.openai_api_key and plugin_config.openai_base_url))
 
 # 构建哔哩哔哩的Credential
 credential = Credential(sessdata=BILI_SESSDATA)
 
-BILIBILI_HEADER = {
-    'User-Agent':
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.4896.127 '
-        'Safari/537.36',
-    'referer': 'https://www.bilibili.com',
-}
+# 解析链接用到的正则，导入时编译一次
+_BV_RE = re.compile(r'^BV[1-9a-zA-Z]{10}$')
+_URL_RE = re.compile(r"(http:|https:)\/\/(space|www|live).bilibili.com\/[A-Za-z\d._?%&+\-=\/#]*")
+_SHORT_URL_RE = re.compile(r"(https?://(?:b23\.tv|bili2233\.cn)/[A-Za-z\d._?%&+\-=\/#]+)")
+_SHORT_HOST_RE = re.compile(r"b23\.tv|bili2233\.cn|QQ小程序")
+_DYNAMIC_ID_RE = re.compile(r'[^/]+(?!.*/)')
+_ROOM_ID_RE = re.compile(r'\/(\d+)')
+_READ_ID_RE = re.compile(r'read\/cv(\d+)')
+_FAV_ID_RE = re.compile(r'favlist\?fid=(\d+)')
+_VIDEO_ID_RE = re.compile(r"video\/([^\\/ ]+)")
+_PAGE_RE = re.compile(r'[?&]p=(\d+)')
+
+# 标题中需要去掉的换行、制表符
+_BORING_CHARS_TABLE = str.maketrans("", "", "\n\t\r")
 
 
 # ==================== 辅助函数 ====================
 
 def delete_boring_characters(text: str) -> str:
-    return re.sub(r'[\n\t\r]', '', text)
+    return text.translate(_BORING_CHARS_TABLE)
+
 
+async def _resolve_short(url: str) -> str:
+    """跟随跳转，解析 b23.tv / bili2233.cn 短链的真实地址"""
+    resp = await get_client().get(url, follow_redirects=True)
+    return str(resp.url)
 
-def get_file_size_mb(file_path):
-    size_in_bytes = os.path.getsize(file_path)
+
+def get_file_size_mb(file_path, size_in_bytes: Optional[int] = None):
+    if size_in_bytes is None:
+        size_in_bytes = os.path.getsize(file_path)
     size_in_mb = size_in_bytes / (1024 * 1024)
     return round(size_in_mb, 2)
 
 
-async def download_video(url: str, ext_headers: dict = None) -> str:
+def remove_file(file_path: str) -> None:
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
+
+
+def write_temp_text(text: str, suffix: str) -> str:
+    with tempfile.NamedTemporaryFile('w', encoding='utf8', suffix=suffix, delete=False) as f:
+        f.write(text)
+    return f.name
+
+
+async def download_video(url: str, ext_headers: dict = None) -> Tuple[str, int]:
     file_name = str(time.time()) + ".mp4"
     headers = {
                   'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
                                 'Chrome/100.0.4896.127 Safari/537.36',
               } | (ext_headers or {})
-    async with httpx.AsyncClient() as client:
-        async with client.stream("GET", url, headers=headers, timeout=60) as resp:
-            async with aiofiles.open(file_name, "wb") as f:
-                async for chunk in resp.aiter_bytes():
-                    await f.write(chunk)
-    return os.path.join(os.getcwd(), file_name)
+    file_size = await download_file(url, file_name, headers=headers, timeout=60)
+    return os.path.join(os.getcwd(), file_name), file_size
 
 
 def make_node_segment(user_id, segments: Union[MessageSegment, List]) -> Union[
     MessageSegment, Iterable[MessageSegment]]:
+    node_custom = partial(MessageSegment.node_custom, user_id=user_id, nickname=GLOBAL_NICKNAME)
     if isinstance(segments, list):
-        return [MessageSegment.node_custom(user_id=user_id, nickname=GLOBAL_NICKNAME,
-                                           content=Message(segment)) for segment in segments]
-    return MessageSegment.node_custom(user_id=user_id, nickname=GLOBAL_NICKNAME,
-                                      content=Message(segments))
+        return [node_custom(content=segment if isinstance(segment, Message) else Message(segment))
+                for segment in segments]
+    return node_custom(content=segments if isinstance(segments, Message) else Message(segments))
 
 
 async def send_forward_both(bot: Bot, event: Event, segments: Union[MessageSegment, List]) -> None:
@@ -115,13 +142,13 @@ async def upload_both(bot: Bot, event: Event, file_path: str, name: str) -> None
         await bot.upload_private_file(user_id=event.user_id, file=file_path, name=name)
 
 
-async def auto_video_send(event: Event, data_path: str):
+async def auto_video_send(event: Event, data_path: str, file_size: Optional[int] = None):
     try:
         bot: Bot = cast(Bot, current_bot.get())
         if data_path is not None and data_path.startswith("http"):
-            data_path = await download_video(data_path)
+            data_path, file_size = await download_video(data_path)
 
-        file_size_in_mb = get_file_size_mb(data_path)
+        file_size_in_mb = get_file_size_mb(data_path, file_size)
         if file_size_in_mb > VIDEO_MAX_MB:
             await bot.send(event, Message(
                 f"当前解析文件 {file_size_in_mb} MB 大于 {VIDEO_MAX_MB} MB，尝试改用文件方式发送，请稍等..."
@@ -132,40 +159,38 @@ async def auto_video_send(event: Event, data_path: str):
     except Exception as e:
         print(f"解析发送出现错误，具体为\n{e}")
     finally:
-        for path in [data_path, f"{data_path}.jpg"]:
-            if path and os.path.exists(path):
-                os.unlink(path)
+        if data_path:
+            remove_file(data_path)
+            remove_file(f"{data_path}.jpg")
 
 
 # ==================== Bilibili 解析器核心 ====================
 
 bili_matcher = on_regex(
-    r"(bilibili.com|b23.tv|bili2233.cn|^BV[0-9a-zA-Z]{10}$)", priority=1, block=True
+    # (?a) 让 \b 只按 ASCII 判断词边界，否则紧跟在中文后面的链接无法触发
+    r"(?a)(?:\b(?:bilibili\.com|b23\.tv|bili2233\.cn)\b|^BV[0-9a-zA-Z]{10}$)", priority=1, block=True
 )
 
 
 @bili_matcher.handle()
 async def handle_bilibili(bot: Bot, event: Event) -> None:
     url: str = str(event.message).strip()
-    url_reg = r"(http:|https:)\/\/(space|www|live).bilibili.com\/[A-Za-z\d._?%&+\-=\/#]*"
-    b_short_rex = r"(https?://(?:b23\.tv|bili2233\.cn)/[A-Za-z\d._?%&+\-=\/#]+)"
 
-    if re.match(r'^BV[1-9a-zA-Z]{10}$', url):
+    if _BV_RE.match(url):
         url = 'https://www.bilibili.com/video/' + url
 
-    if "b23.tv" in url or "bili2233.cn" in url or "QQ小程序" in url:
-        b_short_url = re.search(b_short_rex, url.replace("\\", ""))[0]
-        resp = httpx.get(b_short_url, headers=BILIBILI_HEADER, follow_redirects=True)
-        url: str = str(resp.url)
+    if _SHORT_HOST_RE.search(url):
+        b_short_url = _SHORT_URL_RE.search(url.replace("\\", ""))[0]
+        url: str = await _resolve_short(b_short_url)
     else:
-        match = re.search(url_reg, url)
+        match = _URL_RE.search(url)
         if match:
             url = match.group(0)
 
     if ('t.bilibili.com' in url or '/opus' in url) and BILI_SESSDATA:
         if '?' in url:
             url = url[:url.index('?')]
-        dynamic_id = int(re.search(r'[^/]+(?!.*/)', url)[0])
+        dynamic_id = int(_DYNAMIC_ID_RE.search(url)[0])
         dynamic_info = await Opus(dynamic_id, credential).get_info()
         if dynamic_info:
             title = dynamic_info['item']['basic']['title']
@@ -180,7 +205,7 @@ async def handle_bilibili(bot: Bot, event: Event) -> None:
         return
 
     if 'live' in url:
-        room_id = re.search(r'\/(\d+)', url.split('?')[0]).group(1)
+        room_id = _ROOM_ID_RE.search(url.split('?')[0]).group(1)
         room = live.LiveRoom(room_display_id=int(room_id))
         room_info = (await room.get_room_info())['room_info']
         title, cover, keyframe = room_info['title'], room_info['cover'], room_info['keyframe']
@@ -189,36 +214,37 @@ async def handle_bilibili(bot: Bot, event: Event) -> None:
         return
 
     if 'read' in url:
-        read_id = re.search(r'read\/cv(\d+)', url).group(1)
+        read_id = _READ_ID_RE.search(url).group(1)
         ar = article.Article(read_id)
         if ar.is_note():
             ar = ar.turn_to_note()
         await ar.fetch_content()
-        markdown_path = os.path.join(os.getcwd(), 'article.md')
-        async with aiofiles.open(markdown_path, 'w', encoding='utf8') as f:
-            await f.write(ar.markdown())
-        await bili_matcher.send(Message(f"{GLOBAL_NICKNAME}识别：哔哩哔哩专栏"))
-        await upload_both(bot, event, markdown_path, "article.md")
-        os.remove(markdown_path)
+        markdown_path = await asyncio.to_thread(write_temp_text, ar.markdown(), '.md')
+        try:
+            await bili_matcher.send(Message(f"{GLOBAL_NICKNAME}识别：哔哩哔哩专栏"))
+            await upload_both(bot, event, markdown_path, "article.md")
+        finally:
+            remove_file(markdown_path)
         return
 
     if 'favlist' in url and BILI_SESSDATA:
-        fav_id = re.search(r'favlist\?fid=(\d+)', url).group(1)
+        fav_id = _FAV_ID_RE.search(url).group(1)
         fav_list = (await get_video_favorite_list_content(fav_id))['medias'][:10]
-        favs = [[MessageSegment.image(fav['cover']),
+        covers = await fetch_images([fav['cover'] for fav in fav_list])
+        favs = [[MessageSegment.image(cover),
                  MessageSegment.text(f"🧉 标题：{fav['title']}\n📝 简介：{fav['intro']}\n🔗 链接：{fav['link']}")]
-                for fav in fav_list]
+                for fav, cover in zip(fav_list, covers)]
         await bili_matcher.send(f'{GLOBAL_NICKNAME}识别：哔哩哔哩收藏夹...')
         await send_forward_both(bot, event, make_node_segment(bot.self_id, favs))
         return
 
-    video_id_match = re.search(r"video\/([^\\/ ]+)", url)
+    video_id_match = _VIDEO_ID_RE.search(url)
     if not video_id_match:
         return
     video_id = video_id_match[1]
 
     v = video.Video(bvid=video_id, credential=credential)
-    video_info = await v.get_info()
+    video_info, online = await asyncio.gather(v.get_info(), v.get_online())
     if not video_info:
         await bili_matcher.send(Message(f"{GLOBAL_NICKNAME}识别：B站，出错，无法获取数据！"))
         return
@@ -226,114 +252,119 @@ async def handle_bilibili(bot: Bot, event: Event) -> None:
     video_title, video_cover, video_desc, video_duration = video_info['title'], video_info['pic'], video_info[
         'desc'], video_info['duration']
 
-    page_num = 0
-    if parsed_url := urlparse(url):
-        if query_params := parse_qs(parsed_url.query):
-            page_num = int(query_params.get('p', [1])[0]) - 1
+    page_num = max(int(m.group(1)) - 1, 0) if (m := _PAGE_RE.search(url)) else 0
 
+    video_cid = video_info['cid']
     if 'pages' in video_info and page_num < len(video_info['pages']):
         video_duration = video_info['pages'][page_num].get('duration', video_duration)
+        video_cid = video_info['pages'][page_num].get('cid', video_cid)
 
-    video_title_safe = delete_boring_characters(video_title)
-    online = await v.get_online()
-    online_str = f'🏄‍♂️ 总共 {online["total"]} 人在观看，{online["count"]} 人在网页端观看'
+    # 未配置AI Key时使用B站自带的总结，提前发起请求，与视频下载并行
+    ai_conclusion_task = None
+    if not AI_ENABLED and BILI_SESSDATA:
+        ai_conclusion_task = asyncio.create_task(v.get_ai_conclusion(video_cid))
 
-    info_msg = (
-        f"\n{GLOBAL_NICKNAME}识别：B站，{video_title_safe}\n{extra_bili_info(video_info)}\n"
-        f"📝 简介：{video_desc}\n{online_str}")
+    try:
+        video_title_safe = delete_boring_characters(video_title)
+        online_str = f'🏄‍♂️ 总共 {online["total"]} 人在观看，{online["count"]} 人在网页端观看'
 
-    if video_duration > VIDEO_DURATION_MAXIMUM:
-        await bili_matcher.send(Message(MessageSegment.image(video_cover)) + Message(
-            f"{info_msg}\n--------- \n⚠️ 当前视频时长 {video_duration // 60} 分钟，超过管理员设置的最长时间 {VIDEO_DURATION_MAXIMUM // 60} 分钟！"))
-    else:
-        await bili_matcher.send(Message(MessageSegment.image(video_cover)) + Message(info_msg))
-        download_url_data = await v.get_download_url(page_index=page_num)
-        detecter = VideoDownloadURLDataDetecter(download_url_data)
-        streams = detecter.detect_best_streams()
-        video_url, audio_url = streams[0].url, streams[1].url
+        info_msg = (
+            f"\n{GLOBAL_NICKNAME}识别：B站，{video_title_safe}\n{extra_bili_info(video_info)}\n"
+            f"📝 简介：{video_desc}\n{online_str}")
 
-        path = os.path.join(os.getcwd(), video_id)
-        video_path = f"{path}-video.m4s"
-        audio_path = f"{path}-audio.m4s"
-        output_path = f"{path}-res.mp4"
+        if video_duration > VIDEO_DURATION_MAXIMUM:
+            await bili_matcher.send(Message(MessageSegment.image(video_cover)) + Message(
+                f"{info_msg}\n--------- \n⚠️ 当前视频时长 {video_duration // 60} 分钟，超过管理员设置的最长时间 {VIDEO_DURATION_MAXIMUM // 60} 分钟！"))
+        else:
+            await bili_matcher.send(Message(MessageSegment.image(video_cover)) + Message(info_msg))
+            download_url_data = await v.get_download_url(page_index=page_num)
+            detecter = VideoDownloadURLDataDetecter(download_url_data)
+            streams = detecter.detect_best_streams()
+            video_url, audio_url = streams[0].url, streams[1].url
+
+            path = os.path.join(os.getcwd(), video_id)
+            video_path = f"{path}-video.m4s"
+            audio_path = f"{path}-audio.m4s"
+            output_path = f"{path}-res.mp4"
+
+            try:
+                await asyncio.gather(
+                    download_b_file(video_url, video_path, print),
+                    download_b_file(audio_url, audio_path, print)
+                )
+                await merge_file_to_mp4(video_path, audio_path, output_path)
+                await auto_video_send(event, output_path)
+            finally:
+                remove_file(video_path)
+                remove_file(audio_path)
 
+        # --- 词云与热评分析 ---
         try:
-            await asyncio.gather(
-                download_b_file(video_url, video_path, print),
-                download_b_file(audio_url, audio_path, print)
+            await bili_matcher.send("正在分析弹幕和评论，请稍候...")
+            danmakus, comments, top_comment = await get_danmaku_and_comments_async(
+                cid=video_cid, aid=video_info['aid'], credential=credential
             )
-            await merge_file_to_mp4(video_path, audio_path, output_path)
-            await auto_video_send(event, output_path)
-        finally:
-            for f in [video_path, audio_path]:
-                if os.path.exists(f):
-                    os.remove(f)
 
-    # --- 词云与热评分析 ---
-    try:
-        await bili_matcher.send("正在分析弹幕和评论，请稍候...")
-        danmakus, comments, top_comment = await get_danmaku_and_comments_async(
-            bvid=video_id, aid=video_info['aid'], credential=credential
-        )
-
-        # 发送热评
-        if top_comment:
-            await bili_matcher.send(top_comment)
-
-        # 生成并发送弹幕词云
-        if danmakus:
-            danmaku_wordcloud_bytes = await generate_wordcloud_from_list(danmakus)
-            if danmaku_wordcloud_bytes:
-                await bili_matcher.send(
-                    Message("☁️ 弹幕词云：") + MessageSegment.image(danmaku_wordcloud_bytes)
-                )
+            # 发送热评
+            if top_comment:
+                await bili_matcher.send(top_comment)
+
+            # 生成并发送弹幕词云
+            if danmakus:
+                danmaku_wordcloud_bytes = await generate_wordcloud_from_list(danmakus)
+                if danmaku_wordcloud_bytes:
+                    await bili_matcher.send(
+                        Message("☁️ 弹幕词云：") + MessageSegment.image(danmaku_wordcloud_bytes)
+                    )
+                else:
+                    await bili_matcher.send("弹幕词云生成失败，可能是弹幕数量太少啦。")
             else:
-                await bili_matcher.send("弹幕词云生成失败，可能是弹幕数量太少啦。")
-        else:
-            await bili_matcher.send("该视频暂无弹幕。")
-
-        # 生成并发送评论词云
-        if comments:
-            comment_wordcloud_bytes = await generate_wordcloud_from_list(comments)
-            if comment_wordcloud_bytes:
-                await bili_matcher.send(
-                    Message("☁️ 评论词云：") + MessageSegment.image(comment_wordcloud_bytes)
-                )
+                await bili_matcher.send("该视频暂无弹幕。")
+
+            # 生成并发送评论词云
+            if comments:
+                comment_wordcloud_bytes = await generate_wordcloud_from_list(comments)
+                if comment_wordcloud_bytes:
+                    await bili_matcher.send(
+                        Message("☁️ 评论词云：") + MessageSegment.image(comment_wordcloud_bytes)
+                    )
+                else:
+                    await bili_matcher.send("评论词云生成失败，可能是评论数量太少啦。")
             else:
-                await bili_matcher.send("评论词云生成失败，可能是评论数量太少啦。")
-        else:
-            await bili_matcher.send("该视频暂无评论。")
+                await bili_matcher.send("该视频暂无评论。")
 
-        # --- AI 总结与分析 ---
-        if plugin_config.gemini_key or (plugin_config.openai_api_key and plugin_config.openai_base_url):
-            await bili_matcher.send("🤖 正在生成 AI 总结与分析，请稍候...")
+            # --- AI 总结与分析 ---
+            if AI_ENABLED:
+                await bili_matcher.send("🤖 正在生成 AI 总结与分析，请稍候...")
             
-            # 1. 生成初步总结
-            summary = await get_ai_summary(danmakus, comments)
+                # 1. 生成初步总结
+                summary = await get_ai_summary(danmakus, comments)
             
-            # 2. 基于初步总结和原始数据进行二次分析
-            analysis = await generate_ai_analysis(summary, danmakus, comments)
+                # 2. 基于初步总结和原始数据进行二次分析
+                analysis = await generate_ai_analysis(summary, danmakus, comments)
 
-            # 3. 将总结和分析合并为转发消息发送
-            bot_self_id = bot.self_id
-            forward_messages = [
-                make_node_segment(bot_self_id, f"📝 AI 初步总结:\n{summary}"),
-                make_node_segment(bot_self_id, f"🧠 AI 深度分析:\n{analysis}")
-            ]
-            await send_forward_both(bot, event, forward_messages)
-
-        else:
-            # 如果没有配置AI Key，则尝试使用B站自带的总结
-            if BILI_SESSDATA:
-                ai_conclusion = await v.get_ai_conclusion(await v.get_cid(0))
-                if ai_conclusion.get('model_result', {}).get('summary'):
-                    summary_node = make_node_segment(bot.self_id,
-                                                     ["bilibili AI总结", ai_conclusion['model_result']['summary']])
-                    await send_forward_both(bot, event, summary_node)
-
-
-    except Exception as e:
-        print(f"分析弹幕评论失败: {e}")
-        await bili_matcher.send("分析弹幕和评论时出错了。")
+                # 3. 将总结和分析合并为转发消息发送
+                bot_self_id = bot.self_id
+                forward_messages = [
+                    make_node_segment(bot_self_id, f"📝 AI 初步总结:\n{summary}"),
+                    make_node_segment(bot_self_id, f"🧠 AI 深度分析:\n{analysis}")
+                ]
+                await send_forward_both(bot, event, forward_messages)
 
+            else:
+                # 如果没有配置AI Key，则尝试使用B站自带的总结
+                if ai_conclusion_task:
+                    ai_conclusion = await ai_conclusion_task
+                    if ai_conclusion.get('model_result', {}).get('summary'):
+                        summary_node = make_node_segment(bot.self_id,
+                                                         ["bilibili AI总结", ai_conclusion['model_result']['summary']])
+                        await send_forward_both(bot, event, summary_node)
+
+
+        except Exception as e:
+            print(f"分析弹幕评论失败: {e}")
+            await bili_matcher.send("分析弹幕和评论时出错了。")
+    finally:
+        if ai_conclusion_task and not ai_conclusion_task.done():
+            ai_conclusion_task.cancel()
 
@@ -1,15 +1,17 @@
 import asyncio
 import concurrent.futures
 import contextlib
+import math
 import os
 import platform
 import re
+import socket
 import subprocess
 from functools import partial
 from io import BytesIO
-from typing import List, Optional, Tuple, Dict
+from typing import List, Optional, Tuple, Dict, Union
 
-import aiofiles
+import aiohttp
 import httpx
 import jieba.analyse
 import numpy as np
@@ -17,9 +19,9 @@ import shutil
 from PIL import Image
 from bilibili_api import video, Credential, comment
 from emoji import replace_emoji
-from nonebot import logger
+from lxml import etree
+from nonebot import get_driver, logger
 from wordcloud import WordCloud
-from xml.etree import ElementTree as ET
 
 
 # ==================== 词云生成 ====================
@@ -94,28 +96,96 @@ BILIBILI_HEADER = {
     'referer': 'https://www.bilibili.com',
 }
 
+# 下载时每次写盘的块大小，按块批量落盘，减少逐个小块写入的开销
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# 分段下载时每段的大小和单个文件的最大并发段数
+DOWNLOAD_PART_SIZE = 10 * 1024 * 1024
+DOWNLOAD_MAX_PARTS = 8
+
+# 并发请求评论分页时的最大并发数
+COMMENT_PAGE_CONCURRENCY = 6
+# 预下载图片时的最大并发数
+IMAGE_PREFETCH_CONCURRENCY = 4
+
+_clients: Dict[bool, httpx.AsyncClient] = {}
+_download_sessions: Dict[bool, aiohttp.ClientSession] = {}
+
+
+def get_client(ipv4: bool = False) -> httpx.AsyncClient:
+    """
+        获取全局共享的 AsyncClient，首次调用时创建，复用连接池
+    :param ipv4: 是否绑定 0.0.0.0 强制走 IPv4，仅视频信息、下载地址等原本就这样请求的接口使用
+    :return:
+    """
+    client = _clients.get(ipv4)
+    if client is None or client.is_closed:
+        client = _clients[ipv4] = httpx.AsyncClient(
+            headers=BILIBILI_HEADER,
+            transport=httpx.AsyncHTTPTransport(
+                local_address="0.0.0.0" if ipv4 else None,
+                limits=httpx.Limits(max_keepalive_connections=32),
+            ),
+        )
+    return client
+
+
+def get_download_session(ipv4: bool = False) -> aiohttp.ClientSession:
+    """
+        获取下载音视频用的 aiohttp 会话，大文件流式读取时每块的开销比 httpx 更低
+    :param ipv4: 是否强制走 IPv4，仅B站音视频流下载使用
+    :return:
+    """
+    session = _download_sessions.get(ipv4)
+    if session is None or session.closed:
+        session = _download_sessions[ipv4] = aiohttp.ClientSession(
+            headers=BILIBILI_HEADER,
+            connector=aiohttp.TCPConnector(
+                limit=32, ttl_dns_cache=300, family=socket.AF_INET if ipv4 else socket.AF_UNSPEC
+            ),
+        )
+    return session
+
+
+async def _close_client():
+    for client in _clients.values():
+        await client.aclose()
+    for session in _download_sessions.values():
+        await session.close()
+
+
+# 允许在 nonebot.init() 之前导入本模块，此时没有驱动器可供注册
+with contextlib.suppress(ValueError):
+    get_driver().on_shutdown(_close_client)
+
 
 async def get_danmaku_and_comments_async(
-    bvid: str, aid: int, credential: Credential, max_comments=2000
+    cid: int, aid: int, credential: Credential, max_comments=2000
 ) -> Tuple[List[str], List[str], Optional[str]]:
     """
     异步获取弹幕、评论和热评
+    :param cid: 视频分P的 cid，直接取自视频信息，省去 pagelist 请求
     :return: (弹幕列表, 评论列表, 热评字符串)
     """
 
     async def _get_danmaku() -> List[str]:
         danmaku_list = []
         try:
-            async with httpx.AsyncClient() as client:
-                url = f"https://api.bilibili.com/x/player/pagelist?bvid={bvid}&jsonp=jsonp"
-                resp = await client.get(url, headers=BILIBILI_HEADER)
-                cid = resp.json()["data"][0]["cid"]
-
-                xml_url = f"https://api.bilibili.com/x/v1/dm/list.so?oid={cid}"
-                resp = await client.get(xml_url, headers=BILIBILI_HEADER)
-                resp.encoding = "utf-8"
-                root = ET.fromstring(resp.text)
-                danmaku_list.extend(d.text for d in root.findall("d") if d.text)
+            xml_url = f"https://api.bilibili.com/x/v1/dm/list.so?oid={cid}"
+            # 边下载边解析，只收集 <d> 节点的文本并及时释放节点
+            parser = etree.XMLPullParser(events=("end",), tag="d")
+            async with get_client().stream("GET", xml_url) as resp:
+                # 接口通常返回 deflate 压缩的数据，只有未压缩时才能直接把原始字节交给解析器
+                if resp.headers.get('content-encoding', 'identity') == 'identity':
+                    chunks = resp.aiter_raw(chunk_size=1 << 16)
+                else:
+                    chunks = resp.aiter_bytes(chunk_size=1 << 16)
+                async for chunk in chunks:
+                    parser.feed(chunk)
+                    for _, elem in parser.read_events():
+                        if elem.text:
+                            danmaku_list.append(elem.text)
+                        elem.clear()
+            parser.close()
         except Exception as e:
             logger.error(f"获取弹幕失败: {e}")
         return danmaku_list
@@ -123,36 +193,48 @@ async def get_danmaku_and_comments_async(
     async def _get_comments() -> Tuple[List[str], Optional[Dict]]:
         comments_list = []
         top_comment_obj = None
-        try:
-            page = 1
-            count = 0
-            while count < max_comments:
+        semaphore = asyncio.Semaphore(COMMENT_PAGE_CONCURRENCY)
+
+        async def _get_page(page: int) -> Dict:
+            async with semaphore:
                 res = await comment.get_comments(
                     oid=aid,
                     type_=comment.CommentResourceType.VIDEO,
                     page_index=page,
                     credential=credential
                 )
+                # 每个并发槽位请求后稍作等待，避免触发B站风控
+                await asyncio.sleep(0.3)
+                return res
+
+        try:
+            # 先取第一页拿到评论总数，再并发请求剩余页
+            first_page = await _get_page(1)
+            page_info = first_page["page"]
+            total_pages = min(math.ceil(page_info["count"] / page_info["size"]),
+                              math.ceil(max_comments / page_info["size"]))
+            rest_pages = await asyncio.gather(
+                *[_get_page(page) for page in range(2, total_pages + 1)],
+                return_exceptions=True
+            )
+
+            for res in [first_page, *rest_pages]:
+                if isinstance(res, Exception):
+                    logger.error(f"获取评论失败: {res}")
+                    break
                 replies = res.get("replies", [])
-                if not replies:
+                if not replies or len(comments_list) >= max_comments:
                     break
-                
+
                 # 寻找热评
+                page_top = max(replies, key=lambda r: r['like'])
+                if top_comment_obj is None or page_top['like'] > top_comment_obj['like']:
+                    top_comment_obj = page_top
+
+                # 添加评论到列表，楼中楼回复整批追加
                 for r in replies:
-                    if top_comment_obj is None or r['like'] > top_comment_obj['like']:
-                        top_comment_obj = r
-                    
-                    # 添加评论到列表
                     comments_list.append(r['content']['message'])
-                    count += 1
-                    for reply in r.get("replies", []):
-                        comments_list.append(reply['content']['message'])
-                        count += 1
-
-                if res["page"]["num"] * res["page"]["size"] >= res["page"]["count"]:
-                    break
-                page += 1
-                await asyncio.sleep(0.3)
+                    comments_list.extend(reply['content']['message'] for reply in r.get("replies") or [])
         except Exception as e:
             logger.error(f"获取评论失败: {e}")
         return comments_list, top_comment_obj
@@ -174,6 +256,27 @@ async def get_danmaku_and_comments_async(
     return danmakus, comments, top_comment_str
 
 
+async def fetch_images(urls: List[str]) -> List[Union[bytes, str]]:
+    """
+        限制并发数预先下载图片，发送时直接以 base64 传给协议端，省去协议端再次拉取
+    :param urls: 图片地址列表
+    :return: 与 urls 一一对应的图片内容，下载失败的保留原地址
+    """
+    semaphore = asyncio.Semaphore(IMAGE_PREFETCH_CONCURRENCY)
+
+    async def _fetch(url: str) -> Union[bytes, str]:
+        async with semaphore:
+            try:
+                resp = await get_client().get(url)
+                resp.raise_for_status()
+                return resp.content
+            except httpx.HTTPError as e:
+                logger.warning(f"预下载图片失败: {e}")
+                return url
+
+    return await asyncio.gather(*[_fetch(url) for url in urls])
+
+
 async def is_ffmpeg_installed():
     """检查ffmpeg是否安装"""
 
@@ -207,6 +310,118 @@ async def is_ffmpeg_installed():
 
     return False
 
+async def save_response_stream(resp: aiohttp.ClientResponse, full_file_name: str, progress_callback=None,
+                               offset: Optional[int] = None) -> int:
+    """
+        将流式响应写入文件，文件只打开一次，读到的数据攒满一块后再放到线程中写盘
+    :param resp: 下载会话得到的响应
+    :param full_file_name: 保存路径
+    :param progress_callback: 可选，每写入一块时接收本块的字节数
+    :param offset: 可选，从该偏移处写入已存在的文件（分段下载），默认覆盖写入
+    :return: 写入的总字节数
+    """
+    current_len = 0
+    buffer = bytearray()
+
+    async def _flush():
+        nonlocal current_len
+        await asyncio.to_thread(f.write, buffer)
+        current_len += len(buffer)
+        if progress_callback:
+            progress_callback(len(buffer))
+        buffer.clear()
+
+    if offset is None:
+        f = await asyncio.to_thread(open, full_file_name, "wb")
+    else:
+        f = await asyncio.to_thread(open, full_file_name, "r+b")
+    try:
+        if offset is not None:
+            await asyncio.to_thread(f.seek, offset)
+        async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            buffer += chunk
+            if len(buffer) >= DOWNLOAD_CHUNK_SIZE:
+                await _flush()
+        if buffer:
+            await _flush()
+    finally:
+        await asyncio.to_thread(f.close)
+    return current_len
+
+
+def parts_generator(size: int, part_size: int = DOWNLOAD_PART_SIZE):
+    """
+        将 [0, size) 按 part_size 切分，生成 Range 请求用的 (start, end) 闭区间
+    """
+    for start in range(0, size, part_size):
+        yield start, min(start + part_size, size) - 1
+
+
+def _allocate_file(full_file_name: str, size: int):
+    with open(full_file_name, "wb") as f:
+        f.truncate(size)
+
+
+async def download_file(url: str, full_file_name: str, headers: Optional[Dict] = None,
+                        progress_callback=None, timeout: float = 60, ipv4: bool = False) -> int:
+    """
+        下载文件，服务器支持 Range 时按段并发下载并写入各自偏移，否则退化为单连接流式下载
+    :param url: 下载地址
+    :param full_file_name: 保存路径
+    :param headers: 额外请求头
+    :param progress_callback: 可选，接收 (已下载字节数, 总字节数)
+    :param timeout: 超时时间（秒）
+    :param ipv4: 是否强制走 IPv4
+    :return: 文件大小（字节）
+    """
+    session = get_download_session(ipv4)
+    client_timeout = aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+    current_len = 0
+
+    def on_chunk(chunk_len: int):
+        nonlocal current_len
+        current_len += chunk_len
+        if progress_callback:
+            progress_callback(current_len, total_len)
+
+    # HEAD 只用于探测是否支持分段，失败时直接退化为单连接下载
+    try:
+        async with session.head(url, headers=headers, timeout=client_timeout) as head:
+            total_len = head.content_length or 0
+            ranges_supported = head.status == 200 and head.headers.get('accept-ranges') == 'bytes'
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"探测分段下载失败，改用单连接下载: {e}")
+        total_len, ranges_supported = 0, False
+    if not ranges_supported or total_len <= DOWNLOAD_PART_SIZE:
+        async with session.get(url, headers=headers, timeout=client_timeout) as resp:
+            total_len = resp.content_length or 0
+            return await save_response_stream(resp, full_file_name, on_chunk)
+
+    await asyncio.to_thread(_allocate_file, full_file_name, total_len)
+    semaphore = asyncio.Semaphore(DOWNLOAD_MAX_PARTS)
+
+    async def _download_part(start: int, end: int):
+        async with semaphore:
+            part_headers = (headers or {}) | {'Range': f'bytes={start}-{end}'}
+            async with session.get(url, headers=part_headers, timeout=client_timeout) as resp:
+                if resp.status != 206:
+                    raise aiohttp.ClientResponseError(
+                        resp.request_info, resp.history, status=resp.status, message="分段下载失败"
+                    )
+                await save_response_stream(resp, full_file_name, on_chunk, offset=start)
+
+    tasks = [asyncio.create_task(_download_part(start, end)) for start, end in parts_generator(total_len)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # 任一分段失败时取消其余分段，避免调用方清理文件后仍有分段在下载和写入
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return total_len
+
+
 async def download_b_file(url, full_file_name, progress_callback):
     """
         下载视频文件和音频文件
@@ -215,16 +430,13 @@ async def download_b_file(url, full_file_name, progress_callback):
     :param progress_callback:
     :return:
     """
-    async with httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(local_address="0.0.0.0")) as client:
-        async with client.stream("GET", url, headers=BILIBILI_HEADER) as resp:
-            current_len = 0
-            total_len = int(resp.headers.get('content-length', 0))
-            print(total_len)
-            async with aiofiles.open(full_file_name, "wb") as f:
-                async for chunk in resp.aiter_bytes():
-                    current_len += len(chunk)
-                    await f.write(chunk)
-                    progress_callback(f'下载进度：{round(current_len / total_len, 3)}')
+    await download_file(
+        url, full_file_name,
+        progress_callback=lambda current_len, total_len: progress_callback(
+            f'下载进度：{round(current_len / total_len, 3) if total_len else current_len}'
+        ),
+        ipv4=True
+    )
 
 
 async def merge_file_to_mp4(v_full_file_name: str, a_full_file_name: str, output_file_name: str, log_output: bool = False):
@@ -243,8 +455,9 @@ async def merge_file_to_mp4(v_full_file_name: str, a_full_file_name: str, output
         logger.error('ffmpeg 未安装，请先安装 ffmpeg 并配置环境变量。可参考插件主页说明。')
         return
 
-    # 构建 ffmpeg 命令
-    command = f'ffmpeg -y -i "{v_full_file_name}" -i "{a_full_file_name}" -c copy "{output_file_name}"'
+    # 构建 ffmpeg 命令，只做封装不重新编码；以参数列表直接执行，不经过 shell
+    command = ['ffmpeg', '-y', '-i', v_full_file_name, '-i', a_full_file_name,
+               '-c', 'copy', '-f', 'mp4', output_file_name]
     stdout = None if log_output else subprocess.DEVNULL
     stderr = None if log_output else subprocess.DEVNULL
 
@@ -253,17 +466,16 @@ async def merge_file_to_mp4(v_full_file_name: str, a_full_file_name: str, output
         loop = asyncio.get_event_loop()
         await loop.run_in_executor(
             None,
-            lambda: subprocess.call(command, shell=True, stdout=stdout, stderr=stderr)
+            lambda: subprocess.call(command, stdout=stdout, stderr=stderr)
         )
     else:
-        # 其他平台使用 create_subprocess_shell
-        process = await asyncio.create_subprocess_shell(
-            command,
-            shell=True,
+        # 其他平台使用 create_subprocess_exec
+        process = await asyncio.create_subprocess_exec(
+            *command,
             stdout=stdout,
             stderr=stderr
         )
-        await process.communicate()
+        await process.wait()
 
 
 def extra_bili_info(video_info):
@@ -303,12 +515,8 @@ async def get_bili_video_info(bvid: str):
     :return:
     """
 
-    async with httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(local_address="0.0.0.0")) as client:
-        resp = await client.get(
-            f'https://api.bilibili.com/x/web-interface/view?bvid={bvid}',
-            headers=BILIBILI_HEADER
-        )
-        return resp.json()
+    resp = await get_client(ipv4=True).get(f'https://api.bilibili.com/x/web-interface/view?bvid={bvid}')
+    return resp.json()
 
 
 async def get_bili_video_dl_url(bvid: str, cid: str):
@@ -319,9 +527,5 @@ async def get_bili_video_dl_url(bvid: str, cid: str):
     :return:
     """
 
-    async with httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(local_address="0.0.0.0")) as client:
-        resp = await client.get(
-            f'https://api.bilibili.com/x/player/playurl?bvid={bvid}&cid={cid}&fnval=4048',
-            headers=BILIBILI_HEADER
-        )
-        return resp.json()
+    resp = await get_client(ipv4=True).get(f'https://api.bilibili.com/x/player/playurl?bvid={bvid}&cid={cid}&fnval=4048')
+    return resp.json()